@@ -5,20 +5,20 @@
 # https://ccrma.stanford.edu/~dtyeh/sp12/yeh2007icmcsp12slides.pdf
 
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from math import gcd
 from sys import platform, path
 
 import numpy as np
 
-from scipy.interpolate import interp1d
-from scipy.signal import ( ellip, sosfilt, tf2sos, firwin2, decimate, resample, butter )
-from scipy.spatial import cKDTree
+from scipy.signal import ( ellip, sosfilt, sosfreqz, tf2sos, firwin2, butter, resample_poly, firwin )
 
 from pydub import AudioSegment
 
-from soundfile import write as sf_write
+from soundfile import read as sf_read, write as sf_write
 
 from librosa import load                 as librosa_load
-from librosa.core import resample        as librosa_resample
 from librosa.util import normalize       as librosa_normalize
 from librosa.effects import time_stretch as librosa_time_stretch
 # TODO: could also try pyrubberband.pyrb.time_stretch
@@ -26,7 +26,6 @@ from librosa.effects import time_stretch as librosa_time_stretch
 from moogfilter.moogfilter import MoogFilter
 
 ZOH_MULTIPLIER = 4
-RESAMPLE_MULTIPLIER = 2
 
 INPUT_SR = 96000
 OUTPUT_SR = 48000
@@ -34,6 +33,11 @@ OUTPUT_SR = 48000
 # NOTE: sp-1200 rate 26040, sp-12 rate 27500
 SP_SR = 26040
 
+# polyphase ratio for the output resample, SP_SR -> OUTPUT_SR
+_OUTPUT_GCD = gcd(OUTPUT_SR, SP_SR)
+OUTPUT_RESAMPLE_UP = OUTPUT_SR // _OUTPUT_GCD
+OUTPUT_RESAMPLE_DOWN = SP_SR // _OUTPUT_GCD
+
 OUTPUT_FILTER_TYPES = [
     'lp1', 
     'lp2', 
@@ -52,6 +56,9 @@ NEGATIVE_TUNING_RATIOS = {
     -8: 1.5766735700797954
 }
 
+# ratio change per semitone below -8, linear extrapolation of the last segment (-7 -> -8)
+NEGATIVE_TUNING_SLOPE = NEGATIVE_TUNING_RATIOS[-8] - NEGATIVE_TUNING_RATIOS[-7]
+
 log_levels = {
     'INFO':     logging.INFO,
     'DEBUG':    logging.DEBUG,
@@ -72,16 +79,20 @@ if platform == "darwin":
         AudioSegment.converter = '/usr/local/bin/ffmpeg'
 
 
-def calc_quantize_function(quantize_bits):
+def quantize_uniform(x, bits, u=1, midrise=False):
     # https://dspillustrations.com/pages/posts/misc/quantization-and-quantization-noise.html
-    log.info(f'calculating quantize fn with {quantize_bits} quantize bits')
-    u = 1  # max amplitude to quantize
-    quantization_levels = 2 ** quantize_bits
+    # the codebook is a uniform grid, so the nearest level can be computed
+    # directly instead of searching a table of 2 ** bits levels
+    quantization_levels = 2 ** bits
     delta_s = 2 * u / quantization_levels  # level distance
-    s_midrise = -u + delta_s / 2 + np.arange(quantization_levels) * delta_s
-    s_midtread = -u + np.arange(quantization_levels) * delta_s
-    log.info('done calculating quantize fn')
-    return s_midrise, s_midtread
+    if midrise:
+        k = np.floor((x + u) / delta_s)
+        offset = delta_s / 2 - u
+    else:
+        k = np.round((x + u) / delta_s)
+        offset = -u
+    k = np.clip(k, 0, quantization_levels - 1)
+    return k * delta_s + offset
 
 
 def adjust_pitch(x, st):
@@ -96,93 +107,152 @@ def adjust_pitch(x, st):
     else: # -8 > st
         # output tuning will loses precision/accuracy the further
         # we extrapolate from the device tuning ratios
-        f = interp1d(
-                list(NEGATIVE_TUNING_RATIOS.keys()),
-                list(NEGATIVE_TUNING_RATIOS.values()),
-                fill_value='extrapolate'
-        )
-        t = f(st)
+        t = NEGATIVE_TUNING_RATIOS[-8] + NEGATIVE_TUNING_SLOPE * (-8 - st)
 
     n = int(np.round(len(x) * t))
-    r = np.linspace(0, len(x) - 1, n).round().astype(np.int32)
-    pitched = [x[r[e]] for e in range(n-1)]  # could yield instead
-    pitched = np.array(pitched)
+    # nearest source index for each of the first n - 1 of n evenly spaced points,
+    # round(i * (len(x) - 1) / (n - 1)) in integer arithmetic, exact ties round
+    # half up here where the old linspace(...).round() rounded them half to even
+    d = max(n - 1, 1)
+    r = ((np.arange(n - 1, dtype=np.int64) * (len(x) - 1) + d // 2) // d).astype(np.intp)
+    # single fancy-index gather instead of a per-sample python loop
+    pitched = x[r]
     log.info('done pitching audio')
 
     return pitched
 
 
-def filter_input(x):
-    log.info('applying anti aliasing filter')
-    # NOTE: Might be able to improve accuracy in the 15 -> 20kHz range with firwin?
-    #       Close already, could perfect it at some point, probably not super important now.
-    f = ellip(4, 1, 72, 0.666, analog=False, output='sos')
-    y = sosfilt(f, x)
-    log.info('done applying anti aliasing filter')
-    return y
+# NOTE: never applied directly anymore, input_resample_filter only samples its
+#       magnitude below RESAMPLE_CUTOFF * SP_SR / 2, so only the elliptic passband
+#       ripple reaches the output, its 15 -> 20kHz fit no longer matters.
+INPUT_FILTER_SOS = ellip(4, 1, 72, 0.666, analog=False, output='sos')
 
 
-def lp1(x, sample_rate):
-    log.info(f'applying output eq filter {OUTPUT_FILTER_TYPES[0]}')
+@lru_cache
+def lp1_sos(sample_rate):
     # follows filter curve shown on slide 3
     # cutoff @ 7.5kHz
     freq = np.array([0, 6510, 8000, 10000, 11111, 13020, 15000, 17500, 20000, 24000])
     att = np.array([0, 0, -5, -10, -15, -23, -28, -35, -41, -40])
     gain = np.power(10, att/20)
     f = firwin2(45, freq, gain, fs=sample_rate, antisymmetric=False)
-    sos = tf2sos(f, [1.0])
-    y = sosfilt(sos, x)
+    return tf2sos(f, [1.0]).astype(np.float32)
+
+
+@lru_cache
+def lp2_sos(sample_rate):
+    fc = 10000
+    w = fc / (sample_rate / 2)
+    return butter(7, w, output='sos').astype(np.float32)
+
+
+def blocked_sosfilt(sos, x, block=65536):
+    ''' sosfilt in cache sized blocks, carrying filter state between them '''
+    dtype = np.result_type(sos, x)
+    # zero initial state, same as a single sosfilt call over all of x
+    zi = np.zeros((sos.shape[0], 2), dtype=dtype)
+    y = np.empty(len(x), dtype=dtype)
+    for i in range(0, len(x), block):
+        y[i:i + block], zi = sosfilt(sos, x[i:i + block], zi=zi)
+    return y
+
+
+def lp1(x, sample_rate):
+    log.info(f'applying output eq filter {OUTPUT_FILTER_TYPES[0]}')
+    y = blocked_sosfilt(lp1_sos(sample_rate), x)
     log.info('done applying output eq filter')
     return y
 
 
 def lp2(x, sample_rate):
     log.info(f'applying output eq filter {OUTPUT_FILTER_TYPES[1]}')
-    fc = 10000
-    w = fc / (sample_rate / 2)
-    sos = butter(7, w, output='sos')
-    y = sosfilt(sos, x)
+    y = blocked_sosfilt(lp2_sos(sample_rate), x)
     log.info('done applying output eq filter')
     return y
 
 
-def scipy_resample(y, input_sr, target_sr, factor):
-    ''' resample from input_sr to target_sr_multiple/factor'''
-    log.info(f'resampling audio to sample rate of {target_sr * factor}')
-    seconds = len(y)/input_sr
-    target_samples = int(seconds * (target_sr * factor)) + 1
-    resampled = resample(y, target_samples)
-    log.info('done resample 1/2')
+# fraction of the target nyquist where the resample low pass is -6dB, places the
+# stopband just under target_sr / 2 to roughly match the old decimate chebyshev
+RESAMPLE_CUTOFF = 0.85
+
+
+@lru_cache
+def resample_filter(input_sr, target_sr):
+    ''' resample_poly prototype filter with its stopband below target_sr / 2 '''
+    # resample_poly's default filter is -6dB right at the target nyquist,
+    # which lets content just above it alias back into the top octave
+    g = gcd(input_sr, target_sr)
+    max_rate = max(target_sr // g, input_sr // g)
+    f = firwin(2 * 20 * max_rate + 1, RESAMPLE_CUTOFF / max_rate, window=('kaiser', 8.0))
+    return f.astype(np.float32)
+
+
+@lru_cache
+def input_resample_filter(input_sr, target_sr):
+    ''' resample_filter with the input anti aliasing filter folded in '''
+    # rather than running the elliptic filter over the full rate input first,
+    # impose its magnitude response on the passband of the resample low pass,
+    # same length, window and cutoff as resample_filter so the stopband still
+    # starts below target_sr / 2
+    g = gcd(input_sr, target_sr)
+    up, down = target_sr // g, input_sr // g
+    max_rate = max(up, down)
+    fs = input_sr * up
+    cutoff = RESAMPLE_CUTOFF * target_sr / 2
+    freq = np.linspace(0, cutoff, 32)
+    _, h = sosfreqz(INPUT_FILTER_SOS, worN=freq, fs=input_sr)
+    f = firwin2(
+        2 * 20 * max_rate + 1,
+        np.concatenate((freq, [cutoff, fs / 2])),
+        np.concatenate((np.abs(h), [0, 0])),
+        fs=fs,
+        window=('kaiser', 8.0)
+    )
+    return f.astype(np.float32)
+
+
+def scipy_resample(y, input_sr, target_sr, window=None):
+    ''' resample from input_sr to target_sr'''
+    # single polyphase pass, e.g. 96000 -> 26040 reduces to 217/800
     log.info(f'resampling audio to sample rate of {target_sr}')
-    decimated = decimate(resampled, factor)
-    log.info('done resample 2/2')
+    if window is None:
+        window = resample_filter(input_sr, target_sr)
+    g = gcd(input_sr, target_sr)
+    resampled = resample_poly(y, target_sr // g, input_sr // g, window=window).astype(np.float32, copy=False)
     log.info('done resampling audio')
-    return decimated
+    return resampled
 
 
-def zero_order_hold(y, zoh_multiplier):
+def zoh_resample_filter(zoh_multiplier, up, down):
+    ''' resample_poly prototype filter with the zero order hold folded in '''
     # NOTE: could also try a freq aliased sinc filter
-    log.info(f'applying zero order hold of {zoh_multiplier}')
-    # intentionally oversample by repeating each sample 4 times
-    zoh_applied = np.repeat(y, zoh_multiplier).astype(np.float32)
-    log.info('done applying zero order hold')
-    return zoh_applied
-
-
-def nearest_values(x, y):
-    x, y = map(np.asarray, (x, y))
-    tree = cKDTree(y[:, None])
-    ordered_neighbors = tree.query(x[:, None], 1)[1]
-    return ordered_neighbors
-
-
-def q(x, S, bits):
+    # holding each sample zoh_multiplier times and then upsampling by
+    # up / zoh_multiplier is the same as convolving the up-stuffed input with
+    # zoh_multiplier impulses spaced up / zoh_multiplier apart, so the hold
+    # becomes part of the anti imaging filter instead of a separate 4x buffer
+    spacing = up // zoh_multiplier
+    # same low pass resample_poly designs for the unfused SP_SR * zoh_multiplier
+    # -> OUTPUT_SR ratio (spacing / down), cutoff at the output nyquist so the
+    # zoh images below it are kept, they're the point of the emulation
+    max_rate = max(spacing, down)
+    lpf = firwin(2 * 10 * max_rate + 1, 1 / max_rate, window=('kaiser', 8.0))
+    hold = np.zeros((zoh_multiplier - 1) * spacing + 1)
+    # resample_poly scales the filter by up, the hold only contributes spacing
+    hold[::spacing] = 1 / zoh_multiplier
+    return np.convolve(hold, lpf)
+
+
+OUTPUT_RESAMPLE_FILTER = zoh_resample_filter(
+    ZOH_MULTIPLIER, OUTPUT_RESAMPLE_UP, OUTPUT_RESAMPLE_DOWN
+).astype(np.float32)
+
+
+def q(x, bits, midrise=False):
     # NOTE: no audible difference after audacity invert test @ 12 bits
     #       however, when plotted the scaled amplitude of quantized audio is
     #       noticeably higher than old implementation, leaving for now
     log.info(f'quantizing audio @ {bits} bits')
-    y = nearest_values(x, S)
-    quantized = S.flat[y].reshape(x.shape)
+    quantized = quantize_uniform(x, bits, midrise=midrise)
     log.info('done quantizing')
     return quantized
 
@@ -191,7 +261,7 @@ def q(x, S, bits):
 def write_mp3(f, x, sr):
     """numpy array to MP3"""
     channels = 2 if (x.ndim == 2 and x.shape[1] == 2) else 1
-    # zoh converts to float32, when librosa normalized not selected y still within [-1,1] by here
+    # when librosa normalized not selected y still within [-1,1] by here
     y = np.int16(x * 2 ** 15)
     song = AudioSegment(y.tobytes(), frame_rate=sr, sample_width=2, channels=channels)
     song.export(f, format="mp3", bitrate="320k")
@@ -213,19 +283,20 @@ def process_array(
 
     log.info('done loading')
 
+    # keep the whole chain in float32, scipy upcasts to float64 when given the chance
+    y = np.asarray(y, dtype=np.float32)
 
     if input_filter:
-        y = filter_input(y)
+        log.info('applying anti aliasing filter')
+        resampled = scipy_resample(y, INPUT_SR, SP_SR, window=input_resample_filter(INPUT_SR, SP_SR))
     else:
         log.info('skipping input anti aliasing filter')
-
-    resampled = scipy_resample(y, INPUT_SR, SP_SR, RESAMPLE_MULTIPLIER)
+        resampled = scipy_resample(y, INPUT_SR, SP_SR)
 
     if quantize:
         # TODO: expose midrise option?
         # simulate analog -> digital conversion
-        midrise, midtread = calc_quantize_function(quantize_bits)
-        resampled = q(resampled, midtread, quantize_bits)
+        resampled = q(resampled, quantize_bits)
     else:
         log.info('skipping quantize')
 
@@ -248,16 +319,17 @@ def process_array(
         log.info(f'running custom time stretch of rate: {custom_time_stretch}')
         pitched = librosa_time_stretch(pitched, rate=custom_time_stretch)
 
-    # oversample again (default factor of 4) to simulate ZOH
-    post_zero_order_hold = zero_order_hold(pitched, ZOH_MULTIPLIER)
+    pitched = pitched.astype(np.float32, copy=False)
 
-    # NOTE: why use scipy above and librosa here?
-    #       check git history to see if there was a note about this
-    output = librosa_resample(
-                np.asfortranarray(post_zero_order_hold),
-                orig_sr=SP_SR * ZOH_MULTIPLIER,
-                target_sr=OUTPUT_SR
+    # zoh (default factor of 4) is folded into the output resample filter
+    log.info(f'applying zero order hold of {ZOH_MULTIPLIER} and resampling audio to sample rate of {OUTPUT_SR}')
+    output = resample_poly(
+                pitched,
+                OUTPUT_RESAMPLE_UP,
+                OUTPUT_RESAMPLE_DOWN,
+                window=OUTPUT_RESAMPLE_FILTER
             )
+    log.info('done resampling audio')
 
     if output_filter:
         if output_filter_type == OUTPUT_FILTER_TYPES[0]:
@@ -268,6 +340,8 @@ def process_array(
             output = lp2(output, OUTPUT_SR)
         else:
             # moog vcf approximation, SP outputs 1 & 2 originally used for kicks
+            # built per channel, construction is a few assignments and the ladder
+            # state can't be shared between the concurrently processed channels
             mf = MoogFilter(sample_rate=OUTPUT_SR, cutoff=moog_output_filter_cutoff)
             output = mf.process(output)
     else:
@@ -277,6 +351,35 @@ def process_array(
     return output
 
 
+def load_audio(input_file_path, force_mono=False):
+    log.info(f'loading: "{input_file_path}" at oversampled rate: {INPUT_SR}')
+
+    if '.mp3' in input_file_path.lower():
+        # libsndfile can't decode mp3, fall back to librosa/audioread
+        y, s = librosa_load(input_file_path, sr=INPUT_SR, mono=force_mono)
+        return y
+
+    try:
+        y, file_sr = sf_read(input_file_path, always_2d=True, dtype='float32')
+    except RuntimeError:
+        # other formats libsndfile can't decode (e.g. m4a, aac), same fallback
+        log.info(f'soundfile could not read "{input_file_path}", loading with librosa')
+        y, s = librosa_load(input_file_path, sr=INPUT_SR, mono=force_mono)
+        return y
+
+    # soundfile returns (samples, channels), match librosa's (channels, samples)
+    y = y.T
+    if force_mono or y.shape[0] == 1:
+        y = np.mean(y, axis=0)
+
+    if file_sr != INPUT_SR:
+        log.info(f'resampling input from {file_sr} to {INPUT_SR}')
+        g = gcd(INPUT_SR, file_sr)
+        y = resample_poly(y, INPUT_SR // g, file_sr // g, axis=-1).astype(np.float32, copy=False)
+
+    return y
+
+
 def write_audio(output, output_file_path, normalize_output):
 
     log.info(f'writing {output_file_path}, at sample rate {OUTPUT_SR} with normalize_output set to {normalize_output}')
@@ -337,24 +440,33 @@ def pitch(
         y = input_data
     else:
         # otherwise process the file at intput_file_path
-        log.info(f'loading: "{input_file_path}" at oversampled rate: {INPUT_SR}')
-        y, s = librosa_load(input_file_path, sr=INPUT_SR, mono=force_mono)
+        y = load_audio(input_file_path, force_mono)
 
     if y.ndim == 2:  # stereo
         y1 = y[0]
         y2 = y[1]
 
         log.info('processing stereo channels seperately')
-        log.info('processing channel 1')
-        y1 = process_array(
-            y1, st, input_filter, quantize, time_stretch, output_filter, quantize_bits,
-            custom_time_stretch, output_filter_type, moog_output_filter_cutoff
-        )
-        log.info('processing channel 2')
-        y2 = process_array(
-            y2, st, input_filter, quantize, time_stretch, output_filter, quantize_bits,
-            custom_time_stretch, output_filter_type, moog_output_filter_cutoff
-        )
+        # the resample/sosfilt/time stretch work releases the gil, so the channels
+        # overlap there. MoogFilter.process is a pure python loop that holds the gil,
+        # so the moog output type doesn't gain anything from this.
+        # NOTE: everything process_array calls must be safe to run from two threads
+        #       at once, don't call numba parallel=True kernels from it, the tbb and
+        #       workqueue threading layers deadlock or abort when entered concurrently
+        with ThreadPoolExecutor(max_workers=2) as ex:
+            log.info('submitting channel 1')
+            f1 = ex.submit(
+                process_array,
+                y1, st, input_filter, quantize, time_stretch, output_filter, quantize_bits,
+                custom_time_stretch, output_filter_type, moog_output_filter_cutoff
+            )
+            log.info('submitting channel 2')
+            f2 = ex.submit(
+                process_array,
+                y2, st, input_filter, quantize, time_stretch, output_filter, quantize_bits,
+                custom_time_stretch, output_filter_type, moog_output_filter_cutoff
+            )
+            y1, y2 = f1.result(), f2.result()
         y = np.hstack((y1.reshape(-1, 1), y2.reshape(-1,1)))
         write_audio(y, output_file_path, normalize_output)
     else:  # mono
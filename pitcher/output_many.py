@@ -1,7 +1,6 @@
-from core import pitch, INPUT_SR
+from core import pitch, load_audio
 
 import click
-from librosa import load
 from pathlib import Path
 
 # up
@@ -27,7 +26,7 @@ def output_many(input_file, output_dir):
     if not output_path.is_dir():
         raise ValueError(f'output-dir should be a directory, received: {output_dir}') 
 
-    input_file, s = load(input_file, sr=INPUT_SR, mono=False)
+    input_file = load_audio(input_file)
 
     for st in OUTPUT_MANY_ST_RANGE:
        output_file = f'{in_file_name}_{st}{in_file_type}'